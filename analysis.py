@@ -13,9 +13,12 @@ class Analysis:
     def __init__(self):
         pass
     
-    def run_analysis_stat(self, burn_in_period:int, confidence_level, num_iterations:int, main_labs, main_dr_room, main_bed, ft_labs, ft_dr_room, prob_patient_fast_track, patient_interarrival_dist, tol=0.5):
-        # Run the batch simulations
-        queue_df_list, busy_df_list, queue_bin_df_list, busy_bin_df_list, queue_mavg, busy_mavg = self.run_batch(
+    def run_analysis_stat(self, burn_in_period:int, confidence_level, num_iterations:int, main_labs, main_dr_room, main_bed, ft_labs, ft_dr_room, prob_patient_fast_track, patient_interarrival_dist, tol=0.5, control_variates=False, patient_interarrival_mean=None):
+        if control_variates and patient_interarrival_mean is None:
+            raise ValueError("patient_interarrival_mean must be given to use control variates")
+        
+        # Run the batch simulations, recording arrivals only when they are needed as controls
+        batch_results = self.run_batch(
             num_iterations=num_iterations, 
             batch_run_size=burn_in_period*4, 
             main_labs=main_labs, 
@@ -25,90 +28,168 @@ class Analysis:
             ft_dr_room=ft_dr_room,
             prob_patient_fast_track=prob_patient_fast_track, 
             patient_interarrival_dist=patient_interarrival_dist,
+            get_arrivals=control_variates,
         )
+        queue_bin_df_list, busy_bin_df_list = batch_results[2], batch_results[3]
+        
+        controls, control_means = None, None
+        if control_variates:
+            # Arrivals and the share of them on the main track over the post burn-in window drive most of the
+            # variation between replications, and their expected values are known from the patient settings
+            control_means = self.get_control_means(burn_in_period=burn_in_period, until=burn_in_period*4, prob_patient_fast_track=prob_patient_fast_track, patient_interarrival_mean=patient_interarrival_mean)
+            # A replication without arrivals in the window has no main track fraction, count it as no deviation
+            controls = self.get_controls(arrival_df_list=batch_results[6], burn_in_period=burn_in_period, until=burn_in_period*4).fillna(control_means)
+        
+        # Stack both metrics of every replication into one frame so all statistics come out of a single grouped pass
+        data_df = self.stack_replications(queue_bin_df_list).merge(self.stack_replications(busy_bin_df_list), on=["Replication", "Time", "Station"])
+        results = self.compile_stats_tables(data_df=data_df, burn_in_period=burn_in_period, confidence_level=confidence_level, tol=tol, target_cols=["Queue Length", "Busy Staff"], controls=controls, control_means=control_means)
+
+        return results["Queue Length"], results["Busy Staff"]
+
+    def stack_replications(self, data_df_list: list[pd.DataFrame]):
+        """Concatenate per-replication DataFrames into one, tagging each row with its 'Replication' number."""
+        return pd.concat(data_df_list, keys=range(len(data_df_list)), names=["Replication", None]).reset_index(level=0)
+
+    def get_controls(self, arrival_df_list: list[pd.DataFrame], burn_in_period, until):
+        """Number of arrivals and fraction of main track arrivals in [burn_in_period, until) for each replication."""
+        arrival_df = self.stack_replications(arrival_df_list)
+        arrival_df = arrival_df[(arrival_df["Time"] >= burn_in_period) & (arrival_df["Time"] < until)]
         
-        queue_results_df = self.compile_stats_table(data_bin_df_list=queue_bin_df_list, burn_in_period=burn_in_period, confidence_level=confidence_level, tol=tol, num_iterations=num_iterations, target_col="Queue Length")
-        busy_staff_results_df = self.compile_stats_table(data_bin_df_list=busy_bin_df_list, burn_in_period=burn_in_period, confidence_level=confidence_level, tol=tol, num_iterations=num_iterations, target_col="Busy Staff")
+        controls = pd.DataFrame({
+            "Arrivals": arrival_df.groupby("Replication").size(),
+            "Main Track Fraction": (arrival_df["Type"] == "Main").groupby(arrival_df["Replication"]).mean(),
+        })
+        
+        # Replications without any arrivals in the window still count
+        return controls.reindex(range(len(arrival_df_list))).fillna({"Arrivals": 0})
 
-        return queue_results_df, busy_staff_results_df
+    def get_control_means(self, burn_in_period, until, prob_patient_fast_track, patient_interarrival_mean):
+        """Expected values of the controls returned by get_controls."""
+        return pd.Series({
+            "Arrivals": (until - burn_in_period) / patient_interarrival_mean,
+            "Main Track Fraction": 1 - prob_patient_fast_track,
+        })
 
     def compile_stats_table(self,  data_bin_df_list, burn_in_period, confidence_level, tol, num_iterations, target_col="Queue Length"):
-        # Define a list to store the means of queue lengths for each station across all runs
-        station_mean_values = {station: [] for queue_df in data_bin_df_list for station in queue_df['Station'].unique()}
-        station_within_tol = {station: [] for queue_df in data_bin_df_list for station in queue_df['Station'].unique()}
-
-        # Iterate over each DataFrame in data_bin_df_list
-        for data_df in data_bin_df_list:
-            # Filter out rows before the burn-in period
-            data_df_filtered = data_df[data_df['Time'] >= burn_in_period]
-            
-            # Group the filtered DataFrame by 'Station' to calculate statistics for each station
-            grouped = data_df_filtered.groupby('Station')
-            
-            # Loop over each station and calculate the mean queue length for each run
-            for station, group in grouped:
-                t_score = stats.t.ppf(1 - (1-confidence_level)/2, df=len(group)-1)
-                se = group[target_col].std()
-                within_tol = t_score*se < tol
-                station_within_tol[station].append(within_tol)
-                
-                # Calculate the mean queue length for this station in this simulation run
-                mean_queue_length = group[target_col].mean()
-                
-                # Store the mean queue length for this station in this run
-                station_mean_values[station].append(mean_queue_length)
-
-        # Now, calculate the overall mean and standard deviation of means for each station
-        final_results = []
-        for station, means in station_mean_values.items():
-            # Calculate the mean of means across all runs
-            mean_of_means = np.mean(means)
+        data_df = self.stack_replications(data_bin_df_list)
+        return self.compile_stats_tables(data_df=data_df, burn_in_period=burn_in_period, confidence_level=confidence_level, tol=tol, target_cols=[target_col])[target_col]
+
+    def compile_stats_tables(self, data_df: pd.DataFrame, burn_in_period, confidence_level, tol, target_cols: list[str], controls: pd.DataFrame = None, control_means: pd.Series = None):
+        """Compute the per-station results table of every column in target_cols from replications stacked by stack_replications.
+
+        If controls (one row per replication, one column per control variable) and their expected values control_means
+        are given, control variate adjusted means and confidence intervals are added next to the plain ones.
+        """
+        run_stats = self.get_run_stats(data_df=data_df, burn_in_period=burn_in_period, target_cols=target_cols)
+        return self.compile_run_stats_tables(run_stats=run_stats, confidence_level=confidence_level, tol=tol, target_cols=target_cols, controls=controls, control_means=control_means)
+
+    def get_run_stats(self, data_df: pd.DataFrame, burn_in_period, target_cols: list[str]):
+        """Mean, standard deviation and sample size of every column in target_cols for each station in each simulation run after burn-in."""
+        # Filter out rows before the burn-in period
+        data_df = data_df[data_df['Time'] >= burn_in_period]
+        
+        return data_df.groupby(["Station", "Replication"], sort=False)[target_cols].agg(["mean", "std", "count"])
+
+    def compile_run_stats_tables(self, run_stats: pd.DataFrame, confidence_level, tol, target_cols: list[str], controls: pd.DataFrame = None, control_means: pd.Series = None):
+        """Same as compile_stats_tables, but from per-run statistics laid out as returned by get_run_stats."""
+        q = 1 - (1 - confidence_level) / 2
+        
+        # Mean of the run means, standard deviation of the run means and number of runs for each station
+        station_stats = run_stats.xs("mean", axis=1, level=1).groupby(level="Station", sort=False).agg(["mean", "std", "count"])
+        
+        results = {}
+        for target_col in target_cols:
+            # A run is within tolerance if its confidence interval half-width is below tol
+            t_scores = stats.t.ppf(q, df=run_stats[(target_col, "count")] - 1)
+            within_tol = (t_scores * run_stats[(target_col, "std")] < tol).groupby(level="Station", sort=False).all()
             
-            # Calculate the standard deviation of the means across all runs
-            std_of_means = np.std(means, ddof=1)  # Sample standard deviation (ddof=1)
-            t_score = stats.t.ppf(1 - (1 - confidence_level) / 2, df=num_iterations-1)
+            mean_of_means = station_stats[(target_col, "mean")]
+            std_of_means = station_stats[(target_col, "std")]
             # Calculate the confidence interval using t-distribution
-            margin_of_error = t_score * std_of_means
-            ci_lower = mean_of_means - margin_of_error
-            ci_upper = mean_of_means + margin_of_error
+            margin_of_error = stats.t.ppf(q, df=station_stats[(target_col, "count")] - 1) * std_of_means
             
-            # Store the results for this station
-            final_results.append({
-                "Station": station,
+            results[target_col] = pd.DataFrame({
                 f"Mean {target_col} across all simulations": mean_of_means,
                 "Standard Deviation of Means": std_of_means,
-                f"Average {target_col} Lower Bound": ci_lower,
-                f"Average {target_col} Upper Bound": ci_upper
+                f"Average {target_col} Lower Bound": mean_of_means - margin_of_error,
+                f"Average {target_col} Upper Bound": mean_of_means + margin_of_error,
+                'All Simulations Within Tolerance': within_tol,
             })
             
-        # Convert station_within_tol into a DataFrame and apply .all() to check if all values are True for each station
-        tol_df = pd.DataFrame(station_within_tol).all()
-
-        # Assign a name to the Series
-        tol_df.name = 'All Simulations Within Tolerance'
+            if controls is not None:
+                run_means = run_stats[(target_col, "mean")].unstack("Station")[mean_of_means.index]
+                results[target_col] = results[target_col].join(self.control_variate_estimates(run_means=run_means, controls=controls, control_means=control_means, q=q, target_col=target_col))
 
-        # Join the tol_df (True/False) as a new column to the final_results DataFrame
-        final_results_df = pd.DataFrame(final_results)
-        final_results_df = final_results_df.set_index('Station').join(tol_df)
+        return results
+    
+    def control_variate_estimates(self, run_means: pd.DataFrame, controls: pd.DataFrame, control_means: pd.Series, q, target_col):
+        """Regression control variate estimator for every station (column) of run_means.
 
-        return final_results_df
+        Regressing the run means on the centred controls gives the adjusted mean as the intercept, and its standard
+        error from the usual least squares formula with n - k - 1 degrees of freedom. Each station is fitted on the
+        runs it appears in, so a station that some runs never visit still gets an estimate from the others.
+        """
+        k = len(control_means)
+        centred_controls = controls.loc[run_means.index, control_means.index] - control_means
+        X_all = np.column_stack([np.ones(len(run_means)), centred_controls.to_numpy(dtype=float)])
+        
+        estimates = {}
+        for station in run_means.columns:
+            present = run_means[station].notna().to_numpy()
+            X, y = X_all[present], run_means[station].to_numpy(dtype=float)[present]
+            n, dof = len(y), len(y) - k - 1
+            
+            # Left as NaN when there are too few runs (or a constant control) to fit the regression
+            cv_mean, se_cv = np.nan, np.nan
+            if n > 0:
+                coef, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+                if rank == k + 1:
+                    cv_mean = coef[0]
+                    if dof >= 1:
+                        residual_var = ((y - X @ coef) ** 2).sum() / dof
+                        se_cv = np.sqrt(residual_var * np.linalg.inv(X.T @ X)[0, 0])
+            
+            # Same scale as the plain "Standard Deviation of Means" so the bounds are directly comparable
+            cv_std_of_means = se_cv * np.sqrt(n)
+            margin_of_error = stats.t.ppf(q, df=dof) * cv_std_of_means if dof >= 1 else np.nan
+            
+            # Share of the variance of the plain estimator of the mean removed by the controls
+            plain_var = y.var(ddof=1) / n if n > 1 else np.nan
+            with np.errstate(divide="ignore", invalid="ignore"):
+                variance_reduction = 1 - se_cv**2 / plain_var
+            
+            estimates[station] = {
+                f"CV Mean {target_col} across all simulations": cv_mean,
+                "CV Standard Deviation of Means": cv_std_of_means,
+                f"CV Average {target_col} Lower Bound": cv_mean - margin_of_error,
+                f"CV Average {target_col} Upper Bound": cv_mean + margin_of_error,
+                "CV Variance Reduction": variance_reduction,
+            }
+        
+        return pd.DataFrame.from_dict(estimates, orient="index").rename_axis(run_means.columns.name)
             
-    def run_batch(self, num_iterations:int, batch_run_size:int, main_labs, main_dr_room, main_bed, ft_labs, ft_dr_room, prob_patient_fast_track, patient_interarrival_dist, mavg_list=[5,10]):
+    def run_batch(self, num_iterations:int, batch_run_size:int, main_labs, main_dr_room, main_bed, ft_labs, ft_dr_room, prob_patient_fast_track, patient_interarrival_dist, mavg_list=[5,10], get_arrivals=False):
         queue_df_list = []
         busy_df_list = []
         queue_bin_df_list = []
         busy_bin_df_list = []
+        arrival_df_list = []
         for i in range(num_iterations):
-            queue_df, busy_df, queue_bin_df, busy_bin_df = self.run_simulation(batch_run_size=batch_run_size, main_labs=main_labs, main_dr_room=main_dr_room, main_bed=main_bed, ft_labs=ft_labs, ft_dr_room=ft_dr_room, prob_patient_fast_track=prob_patient_fast_track, patient_interarrival_dist=patient_interarrival_dist,get_bin=True)
+            simulation_results = self.run_simulation(batch_run_size=batch_run_size, main_labs=main_labs, main_dr_room=main_dr_room, main_bed=main_bed, ft_labs=ft_labs, ft_dr_room=ft_dr_room, prob_patient_fast_track=prob_patient_fast_track, patient_interarrival_dist=patient_interarrival_dist,get_bin=True, get_arrivals=get_arrivals)
+            queue_df, busy_df, queue_bin_df, busy_bin_df = simulation_results[:4]
             
             queue_df_list.append(queue_df)
             busy_df_list.append(busy_df)
             queue_bin_df_list.append(queue_bin_df)
             busy_bin_df_list.append(busy_bin_df)
+            if get_arrivals:
+                arrival_df_list.append(simulation_results[4])
         
         queue_mavg = self.get_mavg(simulation_list=queue_bin_df_list, mavg_list=mavg_list)
         busy_mavg = self.get_mavg(simulation_list=busy_bin_df_list, mavg_list=mavg_list)
         
+        if get_arrivals:
+            return queue_df_list, busy_df_list, queue_bin_df_list, busy_bin_df_list, queue_mavg, busy_mavg, arrival_df_list
         return queue_df_list, busy_df_list, queue_bin_df_list, busy_bin_df_list, queue_mavg, busy_mavg
         
     def get_mavg(self, simulation_list: list[pd.DataFrame], mavg_list: list[int]):
@@ -132,7 +213,7 @@ class Analysis:
             
         return average_df  # Return for further use
     
-    def run_simulation(self, batch_run_size:int, main_labs, main_dr_room, main_bed, ft_labs, ft_dr_room, prob_patient_fast_track, patient_interarrival_dist, get_bin=False):
+    def run_simulation(self, batch_run_size:int, main_labs, main_dr_room, main_bed, ft_labs, ft_dr_room, prob_patient_fast_track, patient_interarrival_dist, get_bin=False, get_arrivals=False):
         for station in main_labs + ft_labs + [main_dr_room, ft_dr_room, main_bed]:
             station.reset_station()
         
@@ -144,12 +225,14 @@ class Analysis:
         A = Analysis()
         queue_df, busy_df = A.get_df(ED)
         
-        if get_bin == False:
-            return queue_df, busy_df
-        else:
+        results = (queue_df, busy_df)
+        if get_bin:
             queue_bin_df = A.bin_data(queue_df, until=batch_run_size, target_col="Queue Length")
             busy_bin_df = A.bin_data(busy_df, until=batch_run_size, target_col="Busy Staff")
-            return queue_df, busy_df, queue_bin_df, busy_bin_df
+            results += (queue_bin_df, busy_bin_df)
+        if get_arrivals:
+            results += (pd.DataFrame(ED.arrival_log, columns=["Time", "Patient", "Type"]),)
+        return results
     
     def get_df(self, ED:EmergencyDepartment):
         # Store queue data for plotting
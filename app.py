@@ -1,14 +1,10 @@
-import random
 from collections import Counter
 
 import numpy as np
-import pandas as pd
-import plotly.express as px
-import simpy
 import streamlit as st
 
-from analysis import Analysis
-from simulation import EmergencyDepartment, Station
+# analysis (scipy/simpy), simulation and plotly are imported lazily inside the functions
+# that need them, so widget interactions and cold start don't pay for them
 
 st.set_page_config(layout="wide")  # Expands the page width
 
@@ -75,6 +71,7 @@ def update_distribution_fields(dist_param_container, selected_dist, dist_params,
             station_config["parameters"]["low"] = cols[0].number_input("Lower Bound", value=dist_params.get("low", 1.0), key=f"{station_type} Lab {idx} Uni Low")
             station_config["parameters"]["high"] = cols[1].number_input("Upper Bound", value=dist_params.get("high", 10.0), key=f"{station_type} Lab {idx} Uni High")
 
+@st.fragment
 def station_settings(station_type="Main Lab"):
     emoji = ""
     if "Lab" in station_type:
@@ -149,6 +146,7 @@ def station_settings(station_type="Main Lab"):
             
         check_duplicate_names(station_type=station_type)
 
+@st.fragment
 def patient_settings():
     # Collapsible container for Main Labs
     with st.expander(f"**😷Patients Configuration**", expanded=True):
@@ -181,136 +179,122 @@ station_settings(station_type="Fast Track Lab")
 station_settings(station_type="Fast Track Doctor's Room")
 patient_settings()
 
-def get_distribution_function(distribution_name, parameters):
-    """ Returns a callable function that generates random values from the chosen distribution. """
-    if distribution_name == "Exponential":
-        rate = parameters["rate"]
-        return lambda: np.random.exponential(1 / rate)
-    elif distribution_name == "Normal":
-        mean, std = parameters["mean"], parameters["std"]
-        return lambda: np.random.normal(mean, std)
-    elif distribution_name == "Uniform":
-        low, high = parameters["low"], parameters["high"]
-        return lambda: np.random.uniform(low, high)
-        
 #st.write(st.session_state)
 
-def get_stations_list(station_type="Main Lab"):
-    # Convert session state labs to Station objects
-    stations_list = [
-        Station(
-            name=station_config['name'],
-            num_staff=station_config['num_staff'],
-            treatment_time_dist=get_distribution_function(station_config['distribution'], station_config['parameters']),
-            prob_station_needed=station_config['prob_station_needed']
-        )
-        for station_config in st.session_state.stations[station_type]
-    ]
-    
-    return stations_list
+def get_ed_settings():
+    """ Builds the EmergencyDepartment inputs from the configurations stored in session state. """
+    from simulation import get_ed_settings as build_ed_settings
 
-st.write("Check For Initialisation Bias in this Section")
-with st.container():
-    cols = st.columns(4)
-    # Run simulation button outside the container
-    until = cols[1].number_input("Simulation Duration", value=12000)
-    mavg_value_1 = cols[2].number_input("1st Moving Average Window", value=10)
-    mavg_value_2 = cols[3].number_input("2nd Moving Average Window", value=30)
-    with cols[0]:
-        st.write(" ")
-        check_ini_bias_btn = st.button("Check Initialisation Bias")
+    return build_ed_settings(st.session_state.stations, st.session_state.patient["Patient"])
 
-    if check_ini_bias_btn:
-        env = simpy.Environment()
+def show_ini_bias_results(results):
+    import plotly.express as px
 
-        main_labs_list = get_stations_list(station_type="Main Lab")
-        main_dr_room = get_stations_list(station_type="Main Doctor's Room")[0]
-        main_bed = get_stations_list(station_type="Main Beds")[0]
-        
-        ft_labs_list = get_stations_list(station_type="Fast Track Lab")
-        ft_dr_room = get_stations_list(station_type="Fast Track Doctor's Room")[0]
-        
-        prob_patient_fast_track=st.session_state.patient["Patient"]["prob_patient_fast_track"]
-        patient_interarrival_dist=get_distribution_function(st.session_state.patient["Patient"]['distribution'], st.session_state.patient["Patient"]['parameters'])
+    queue_mavg, busy_mavg = results["queue_mavg"], results["busy_mavg"]
+    
+    # Streamlit app content for the ED page
+    st.subheader("📊 Emergency Department Simulation Results")
+
+    # Display a message explaining the simulation
+    st.write(
+        "This page displays the queue length over time for various stations in the Emergency Department. "
+        "You can use this visualization to track the workload at each station during the simulation."
+    )
+    
+    st.write("Queue Length Welch's Test")
+    tab_names = [col for col in queue_mavg.columns if col not in {"Time", "Station"}]
 
+    # Create separate tabs first
+    tabs = st.tabs(tab_names)
+
+    # Assign each plot to its respective tab
+    for i, tab in enumerate(tabs):
+        with tab:  # Ensure each plot is inside the correct tab
+            fig_queue_mavg = px.line(queue_mavg, x='Time', y=tab_names[i], color='Station', 
+                                title=f"Queue Length at Each Station{tab_names[i]} Over Time", 
+                                line_shape='hv')
+            st.plotly_chart(fig_queue_mavg, key=f"queue_mavg_{i}")
+            
+            fig_busy_mavg = px.line(busy_mavg, x='Time', y=tab_names[i], color='Station', 
+                                title=f"Busy Staff at Each Station {tab_names[i]} Over Time",
+                                line_shape='hv')
+            st.plotly_chart(fig_busy_mavg, key=f"busy_mavg_{i}")
             
-        # Create a new simulation environment
-        ED = EmergencyDepartment(env, main_labs=main_labs_list, main_dr_room=main_dr_room, main_bed=main_bed, ft_labs=ft_labs_list, ft_dr_room=ft_dr_room, prob_patient_fast_track=prob_patient_fast_track, patient_interarrival_dist=patient_interarrival_dist)
-        # Run the simulation
-        ED.run(until=until)
+    with st.expander("Individual simulations"):
+        tab_names = ["Simulation " + str(i) for i in range(1, results["num_iterations"]+1)]
+        for i,tab in enumerate(st.tabs(tab_names)):
+            with tab:
+                # Plotting the queue length data using Plotly
+                st.write("Queue Length at Each Station Over Time")
+                st.line_chart(results["queue_df_list"][i], x='Time', y='Queue Length', color='Station')
 
-        A = Analysis()
-        queue_df, busy_df = A.get_df(ED)
-        
-        # Streamlit app content for the ED page
-        st.subheader("📊 Emergency Department Simulation Results")
+                # Plotting the busy staff data using Plotly
+                st.write("Number of Busy Staff at Each Station Over Time")
+                st.line_chart(results["busy_df_list"][i], x='Time', y='Busy Staff', color='Station')
 
-        # Display a message explaining the simulation
-        st.write(
-            "This page displays the queue length over time for various stations in the Emergency Department. "
-            "You can use this visualization to track the workload at each station during the simulation."
-        )
-        
-        num_iterations = 5
-        
-        queue_df_list, busy_df_list, queue_bin_df_list, busy_bin_df_list, queue_mavg, busy_mavg = A.run_batch(num_iterations=num_iterations, batch_run_size=until, main_labs=main_labs_list, main_dr_room=main_dr_room, main_bed=main_bed, ft_labs=ft_labs_list, ft_dr_room=ft_dr_room, mavg_list=[mavg_value_1, mavg_value_2], prob_patient_fast_track=prob_patient_fast_track, patient_interarrival_dist=patient_interarrival_dist)
-        
-        st.write("Queue Length Welch's Test")
-        tab_names = [col for col in queue_mavg.columns if col not in {"Time", "Station"}]
+# Each results section is its own fragment: its buttons only rerun that section, and the
+# results are kept in session state so they survive reruns triggered anywhere else
+@st.fragment
+def initialisation_bias_section():
+    st.write("Check For Initialisation Bias in this Section")
+    with st.container():
+        cols = st.columns(4)
+        # Run simulation button outside the container
+        until = cols[1].number_input("Simulation Duration", value=12000)
+        mavg_value_1 = cols[2].number_input("1st Moving Average Window", value=10)
+        mavg_value_2 = cols[3].number_input("2nd Moving Average Window", value=30)
+        with cols[0]:
+            st.write(" ")
+            check_ini_bias_btn = st.button("Check Initialisation Bias")
 
-        # Create separate tabs first
-        tabs = st.tabs(tab_names)
+        if check_ini_bias_btn:
+            from analysis import Analysis
 
-        # Assign each plot to its respective tab
-        for i, tab in enumerate(tabs):
-            with tab:  # Ensure each plot is inside the correct tab
-                fig_queue_mavg = px.line(queue_mavg, x='Time', y=tab_names[i], color='Station', 
-                                    title=f"Queue Length at Each Station{tab_names[i]} Over Time", 
-                                    line_shape='hv')
-                st.plotly_chart(fig_queue_mavg, key=f"queue_mavg_{i}")
-                
-                fig_busy_mavg = px.line(busy_mavg, x='Time', y=tab_names[i], color='Station', 
-                                    title=f"Busy Staff at Each Station {tab_names[i]} Over Time",
-                                    line_shape='hv')
-                st.plotly_chart(fig_busy_mavg, key=f"busy_mavg_{i}")
-                
-        with st.expander("Individual simulations"):
-            tab_names = ["Simulation " + str(i) for i in range(1,num_iterations+1)]
-            for i,tab in enumerate(st.tabs(tab_names)):
-                with tab:
-                    # Plotting the queue length data using Plotly
-                    st.write("Queue Length at Each Station Over Time")
-                    st.line_chart(queue_df_list[i], x='Time', y='Queue Length', color='Station')
+            num_iterations = 5
+            
+            A = Analysis()
+            queue_df_list, busy_df_list, queue_bin_df_list, busy_bin_df_list, queue_mavg, busy_mavg = A.run_batch(num_iterations=num_iterations, batch_run_size=until, mavg_list=[mavg_value_1, mavg_value_2], **get_ed_settings())
+            
+            st.session_state.ini_bias_results = {
+                "num_iterations": num_iterations,
+                "queue_df_list": queue_df_list,
+                "busy_df_list": busy_df_list,
+                "queue_mavg": queue_mavg,
+                "busy_mavg": busy_mavg,
+            }
 
-                    # Plotting the busy staff data using Plotly
-                    st.write("Number of Busy Staff at Each Station Over Time")
-                    st.line_chart(busy_df_list[i], x='Time', y='Busy Staff', color='Station')
-                
-st.write("Get simulation results here")
-with st.container():
-    cols = st.columns(4)
-    burn_in_period = cols[1].number_input("Burn in Period", value=3200, min_value=400)
-    num_iterations = cols[2].number_input("Num Iterations", value=20)
-    confidence_level = cols[3].number_input("Confidence Interval", value=0.95)
-    with cols[0]:
-        st.write(" ")
-        st.write(" ")
-        results_btn = st.button("Get Simulation Results")
-    if results_btn:
-        env = simpy.Environment()
+        if "ini_bias_results" in st.session_state:
+            show_ini_bias_results(st.session_state.ini_bias_results)
 
-        main_labs_list = get_stations_list(station_type="Main Lab")
-        main_dr_room = get_stations_list(station_type="Main Doctor's Room")[0]
-        main_bed = get_stations_list(station_type="Main Beds")[0]
-        
-        ft_labs_list = get_stations_list(station_type="Fast Track Lab")
-        ft_dr_room = get_stations_list(station_type="Fast Track Doctor's Room")[0]
-        
-        prob_patient_fast_track=st.session_state.patient["Patient"]["prob_patient_fast_track"]
-        patient_interarrival_dist=get_distribution_function(st.session_state.patient["Patient"]['distribution'], st.session_state.patient["Patient"]['parameters'])
-        
-        A = Analysis()
-        queue_results_df, busy_staff_results_df = A.run_analysis_stat(burn_in_period=burn_in_period, confidence_level=confidence_level, num_iterations=num_iterations, main_labs=main_labs_list, main_dr_room=main_dr_room, main_bed=main_bed, ft_labs=ft_labs_list, ft_dr_room=ft_dr_room, prob_patient_fast_track=prob_patient_fast_track, patient_interarrival_dist=patient_interarrival_dist)
-        
-        st.dataframe(queue_results_df)
-        st.dataframe(busy_staff_results_df)
\ No newline at end of file
+@st.fragment
+def simulation_results_section():
+    st.write("Get simulation results here")
+    with st.container():
+        cols = st.columns(5)
+        burn_in_period = cols[1].number_input("Burn in Period", value=3200, min_value=400)
+        num_iterations = cols[2].number_input("Num Iterations", value=20)
+        confidence_level = cols[3].number_input("Confidence Interval", value=0.95)
+        with cols[4]:
+            st.write(" ")
+            st.write(" ")
+            control_variates = st.checkbox("Control Variates", help="Also report means and confidence intervals adjusted for the number of arrivals and the share of main track patients")
+        with cols[0]:
+            st.write(" ")
+            st.write(" ")
+            results_btn = st.button("Get Simulation Results")
+        if results_btn:
+            from analysis import Analysis
+            from simulation import get_distribution_mean
+
+            A = Analysis()
+            queue_results_df, busy_staff_results_df = A.run_analysis_stat(burn_in_period=burn_in_period, confidence_level=confidence_level, num_iterations=num_iterations, control_variates=control_variates, patient_interarrival_mean=get_distribution_mean(st.session_state.patient["Patient"]['distribution'], st.session_state.patient["Patient"]['parameters']), **get_ed_settings())
+            
+            st.session_state.stat_results = (queue_results_df, busy_staff_results_df)
+
+        if "stat_results" in st.session_state:
+            queue_results_df, busy_staff_results_df = st.session_state.stat_results
+            st.dataframe(queue_results_df)
+            st.dataframe(busy_staff_results_df)
+
+initialisation_bias_section()
+simulation_results_section()
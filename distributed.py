@@ -0,0 +1,342 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from analysis import Analysis
+from simulation import get_distribution_mean, get_ed_settings
+
+TARGET_COLS = ["Queue Length", "Busy Staff"]
+
+# A scenario spec is plain JSON so it can be sent to workers, laid out like the Streamlit session state:
+# {"stations": {station_type: [station_config, ...]}, "patient": patient_config, "burn_in_period": int}
+# The default is the app's default configuration and burn-in period
+DEFAULT_SPEC = {
+    "stations": {
+        "Main Lab": [
+            {"name": "Main Lab 1", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 1},
+            {"name": "Main Lab 2", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 0.5},
+            {"name": "Main Lab 3", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 0.5},
+            {"name": "Main Lab 4", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 0.5},
+        ],
+        "Fast Track Lab": [
+            {"name": "Fast Track Lab 1", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 1},
+        ],
+        "Main Doctor's Room": [
+            {"name": "Main Doctor's Room", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 1}
+        ],
+        "Fast Track Doctor's Room": [
+            {"name": "Fast Track Doctor's Room", "num_staff": 1, "distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_station_needed": 1}
+        ],
+        "Main Beds": [
+            {"name": "Main Beds", "num_staff": 30, "distribution": "Exponential", "parameters": {"rate": 1/720}, "prob_station_needed": 0.01}
+        ],
+    },
+    "patient": {"distribution": "Exponential", "parameters": {"rate": 1/5}, "prob_patient_fast_track": 0.8},
+    "burn_in_period": 3200,
+}
+
+
+def send_message(sock: socket.socket, message: dict):
+    """Send a length-prefixed JSON message"""
+    data = json.dumps(message).encode()
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def recv_message(sock: socket.socket):
+    """Receive a length-prefixed JSON message"""
+    (length,) = struct.unpack("!I", _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, length))
+
+def _recv_exactly(sock: socket.socket, num_bytes: int):
+    data = bytearray()
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed before the full message was received")
+        data += chunk
+    return bytes(data)
+
+
+def run_replication(spec: dict, seed: int):
+    """Run one replication of a scenario and summarise it.
+
+    Only the post burn-in statistics of each station and the control variables are returned, so the summary stays small
+    whatever the run length. The same spec and seed always give the same summary.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+    burn_in_period = spec["burn_in_period"]
+    until = burn_in_period*4
+
+    A = Analysis()
+    # The simulation prints every event, which would dominate the run time of a worker
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        queue_df, busy_df, queue_bin_df, busy_bin_df, arrival_df = A.run_simulation(batch_run_size=until, get_bin=True, get_arrivals=True, **get_ed_settings(spec["stations"], spec["patient"]))
+
+    data_df = A.stack_replications([queue_bin_df]).merge(A.stack_replications([busy_bin_df]), on=["Replication", "Time", "Station"])
+    run_stats = A.get_run_stats(data_df=data_df, burn_in_period=burn_in_period, target_cols=TARGET_COLS).droplevel("Replication")
+    controls = A.get_controls(arrival_df_list=[arrival_df], burn_in_period=burn_in_period, until=until).iloc[0]
+
+    return {
+        "stations": run_stats.index.tolist(),
+        "stats": {target_col: {stat: run_stats[(target_col, stat)].tolist() for stat in ["mean", "std", "count"]} for target_col in TARGET_COLS},
+        "controls": {name: float(value) for name, value in controls.items()},
+    }
+
+
+class Worker:
+    """Runs replications for a Coordinator.
+
+    Each connection carries one task: {"type": "task", "task_id", "spec", "seeds"}. A "replication" message is streamed back
+    for every seed as soon as it finishes, followed by "done", or "error" if the scenario cannot be simulated.
+    """
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+
+    def serve_forever(self):
+        with self.server:
+            while True:
+                conn, _ = self.server.accept()
+                with conn:
+                    try:
+                        self.handle_task(conn)
+                    except (OSError, ValueError) as e:
+                        # Coordinator went away or sent something that isn't a message, it will retry the task elsewhere
+                        print(f"Worker {self.address}: lost connection ({e})")
+                    except Exception as e:
+                        # One bad task must not take the worker down for every other coordinator
+                        print(f"Worker {self.address}: task failed ({e!r})")
+                        try:
+                            send_message(conn, {"type": "error", "message": repr(e)})
+                        except OSError:
+                            pass
+
+    def handle_task(self, conn: socket.socket):
+        message = recv_message(conn)
+        if not isinstance(message, dict) or message.get("type") != "task" or not {"task_id", "spec", "seeds"} <= message.keys():
+            send_message(conn, {"type": "error", "message": "Expected a task message with task_id, spec and seeds"})
+            return
+        task_id = message["task_id"]
+        for seed in message["seeds"]:
+            try:
+                summary = run_replication(message["spec"], seed)
+            except Exception as e:
+                send_message(conn, {"type": "error", "task_id": task_id, "seed": seed, "message": repr(e)})
+                return
+            send_message(conn, {"type": "replication", "task_id": task_id, "seed": seed, "summary": summary})
+        send_message(conn, {"type": "done", "task_id": task_id})
+
+
+class Coordinator:
+    """Spreads replications over Workers and gathers their summaries.
+
+    Seeds are split into tasks of chunk_size seeds, and each worker address is driven by its own thread pulling tasks from
+    a shared queue. If a worker fails or times out, the seeds it had not returned yet are put back on the queue for any
+    worker, up to max_attempts times per seed. A worker that fails stays in rotation after a short back-off, and is only
+    retired after max_worker_failures failures in a row. Results are ordered by seed, not by arrival, so runs are
+    reproducible.
+    """
+    def __init__(self, worker_addresses: list[tuple[str, int]], chunk_size=5, max_attempts=3, timeout=600, max_worker_failures=3, backoff=1.0):
+        self.worker_addresses = [tuple(address) for address in worker_addresses]
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.max_worker_failures = max_worker_failures
+        self.backoff = backoff
+
+    def run_replications(self, spec: dict, seeds: list[int]):
+        """Run one replication of spec per seed and return their summaries in the order of seeds"""
+        # Seeds go into JSON messages, so numpy integers must become plain ints
+        seeds = [int(seed) for seed in seeds]
+        run = _Run(spec)
+        for task_id, i in enumerate(range(0, len(seeds), self.chunk_size)):
+            run.tasks.put({"task_id": task_id, "seeds": seeds[i:i + self.chunk_size], "attempts": 0})
+
+        threads = [threading.Thread(target=self._drive_worker, args=(address, run), daemon=True) for address in self.worker_addresses]
+        for thread in threads:
+            thread.start()
+
+        with run.finished:
+            while len(run.results) < len(set(seeds)) and run.error is None:
+                if not any(thread.is_alive() for thread in threads):
+                    missing = [seed for seed in seeds if seed not in run.results]
+                    run.error = RuntimeError(f"All workers failed, replications not run for seeds {missing}")
+                    break
+                run.finished.wait(timeout=1)
+
+        # Interrupt the tasks still running and wait for every thread, so nothing outlives this call
+        run.stop_all()
+        for thread in threads:
+            thread.join()
+
+        if run.error is not None:
+            raise run.error
+        return [run.results[seed] for seed in seeds]
+
+    def _drive_worker(self, address, run: "_Run"):
+        failures = 0
+        while not run.stop.is_set():
+            try:
+                task = run.tasks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            remaining = list(task["seeds"])
+            started = False
+            try:
+                with socket.create_connection(address, timeout=self.timeout) as sock:
+                    run.add_socket(sock)
+                    send_message(sock, {"type": "task", "task_id": task["task_id"], "spec": run.spec, "seeds": remaining})
+                    started = True
+                    while remaining and not run.stop.is_set():
+                        message = recv_message(sock)
+                        if message["type"] == "error":
+                            # The scenario itself is broken, running it elsewhere would fail the same way
+                            run.fail(RuntimeError(f"Worker {address} failed on seed {message.get('seed')}: {message['message']}"))
+                            return
+                        if message["type"] == "replication" and message["seed"] in remaining:
+                            remaining.remove(message["seed"])
+                            with run.finished:
+                                run.results[message["seed"]] = message["summary"]
+                                run.finished.notify_all()
+                failures = 0
+            except Exception as e:
+                if run.stop.is_set():
+                    # The run is over and the socket was closed under us, nothing left to retry
+                    return
+                # Only a task the worker started counts as an attempt, a worker that can't be reached didn't run it
+                task = {**task, "seeds": remaining, "attempts": task["attempts"] + started}
+                if task["attempts"] >= self.max_attempts:
+                    run.fail(RuntimeError(f"Seeds {remaining} failed {task['attempts']} times, last on worker {address}: {e!r}"))
+                    return
+                run.tasks.put(task)
+
+                failures += 1
+                if failures >= self.max_worker_failures:
+                    print(f"Worker {address} failed {failures} times in a row ({e!r}), retiring it")
+                    return
+                print(f"Worker {address} failed ({e!r}), retrying seeds {remaining}")
+                # Give the other workers a chance to take the task before this one is tried again
+                run.stop.wait(self.backoff * failures)
+
+    def run_analysis_stat(self, spec: dict, confidence_level, num_iterations: int, tol=0.5, control_variates=False, base_seed=0):
+        """Distributed counterpart of Analysis.run_analysis_stat, with replication i seeded by base_seed + i"""
+        summaries = self.run_replications(spec, seeds=range(base_seed, base_seed + num_iterations))
+
+        run_stats = pd.concat([
+            pd.DataFrame(
+                {(target_col, stat): values for target_col in TARGET_COLS for stat, values in summary["stats"][target_col].items()},
+                index=pd.MultiIndex.from_product([summary["stations"], [i]], names=["Station", "Replication"]),
+            )
+            for i, summary in enumerate(summaries)
+        ])
+
+        A = Analysis()
+        controls, control_means = None, None
+        if control_variates:
+            burn_in_period = spec["burn_in_period"]
+            control_means = A.get_control_means(
+                burn_in_period=burn_in_period,
+                until=burn_in_period*4,
+                prob_patient_fast_track=spec["patient"]["prob_patient_fast_track"],
+                patient_interarrival_mean=get_distribution_mean(spec["patient"]["distribution"], spec["patient"]["parameters"]),
+            )
+            controls = pd.DataFrame([summary["controls"] for summary in summaries]).fillna(control_means)
+
+        results = A.compile_run_stats_tables(run_stats=run_stats, confidence_level=confidence_level, tol=tol, target_cols=TARGET_COLS, controls=controls, control_means=control_means)
+
+        return results["Queue Length"], results["Busy Staff"]
+
+
+class _Run:
+    """State of one Coordinator.run_replications call, shared with its worker threads only"""
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.tasks = queue.Queue()
+        self.results = {}
+        self.error = None
+        self.finished = threading.Condition()
+        self.stop = threading.Event()
+        self._sockets = set()
+        self._sockets_lock = threading.Lock()
+
+    def add_socket(self, sock: socket.socket):
+        with self._sockets_lock:
+            self._sockets.add(sock)
+        if self.stop.is_set():
+            self.stop_all()
+
+    def fail(self, error):
+        with self.finished:
+            if self.error is None:
+                self.error = error
+            self.finished.notify_all()
+        self.stop_all()
+
+    def stop_all(self):
+        """Stop the worker threads, unblocking any that are waiting on a worker"""
+        self.stop.set()
+        with self._sockets_lock:
+            for sock in self._sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def _serve_local_worker(address_queue):
+    worker = Worker()
+    address_queue.put(worker.address)
+    worker.serve_forever()
+
+def start_local_workers(num_workers: int):
+    """Start num_workers Worker processes on localhost ports, returning the processes and their addresses"""
+    address_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_serve_local_worker, args=(address_queue,), daemon=True) for _ in range(num_workers)]
+    for process in processes:
+        process.start()
+    addresses = [address_queue.get(timeout=30) for _ in processes]
+    return processes, addresses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Emergency Department replications over several worker processes or nodes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = subparsers.add_parser("worker", help="Serve replications to a coordinator")
+    worker_parser.add_argument("--host", default="127.0.0.1")
+    worker_parser.add_argument("--port", type=int, default=5000)
+
+    run_parser = subparsers.add_parser("run", help="Run the default scenario on workers")
+    run_parser.add_argument("--workers", nargs="*", default=[], help="host:port of running workers, local workers are started if none are given")
+    run_parser.add_argument("--num-local-workers", type=int, default=4)
+    run_parser.add_argument("--num-iterations", type=int, default=20)
+    run_parser.add_argument("--confidence-level", type=float, default=0.95)
+    run_parser.add_argument("--control-variates", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        worker = Worker(host=args.host, port=args.port)
+        print(f"Worker listening on {worker.address}")
+        worker.serve_forever()
+    else:
+        addresses = [(host, int(port)) for host, port in (worker.rsplit(":", 1) for worker in args.workers)]
+        if not addresses:
+            processes, addresses = start_local_workers(args.num_local_workers)
+
+        C = Coordinator(addresses)
+        queue_results_df, busy_staff_results_df = C.run_analysis_stat(DEFAULT_SPEC, confidence_level=args.confidence_level, num_iterations=args.num_iterations, control_variates=args.control_variates)
+        print(queue_results_df)
+        print(busy_staff_results_df)
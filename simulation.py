@@ -1,14 +1,35 @@
 import random
 from typing import Literal, Optional
 
+import numpy as np
 import pandas as pd
-import plotly.express as px
 import simpy
 
 PATIENT_INTERARRIVAL_DIST = lambda: random.expovariate(1 / 5)
 TREATMENT_TIME_DIST = lambda: random.expovariate(1 / 3)
 PROB_PATIENT_FAST_TRACK = 0.8
 
+def get_distribution_function(distribution_name, parameters):
+    """ Returns a callable function that generates random values from the chosen distribution. """
+    if distribution_name == "Exponential":
+        rate = parameters["rate"]
+        return lambda: np.random.exponential(1 / rate)
+    elif distribution_name == "Normal":
+        mean, std = parameters["mean"], parameters["std"]
+        return lambda: np.random.normal(mean, std)
+    elif distribution_name == "Uniform":
+        low, high = parameters["low"], parameters["high"]
+        return lambda: np.random.uniform(low, high)
+
+def get_distribution_mean(distribution_name, parameters):
+    """ Returns the expected value of the chosen distribution. """
+    if distribution_name == "Exponential":
+        return 1 / parameters["rate"]
+    elif distribution_name == "Normal":
+        return parameters["mean"]
+    elif distribution_name == "Uniform":
+        return (parameters["low"] + parameters["high"]) / 2
+
 class Station:
     def __init__(self, num_staff, name="Lab1", treatment_time_dist=random.expovariate(1 / 5), prob_station_needed=1.0):
         self._env = None  # Initially set to None
@@ -128,6 +149,7 @@ class EmergencyDepartment:
         # patient environment set-up
         self.prob_patient_fast_track = prob_patient_fast_track
         self.patient_interarrival_dist = patient_interarrival_dist
+        self.arrival_log = []  # Log of patient arrivals over time
 
     def run(self, until):
         self.env.process(self.spawn_patients())  # Continuously spawn patients
@@ -147,10 +169,40 @@ class EmergencyDepartment:
                 patient = Patient(env=self.env, patient_num=patient_num, type='Main')
                 # make patient go through ED processes
                 self.env.process(patient.process(labs=self.main_labs, dr_room=self.main_dr_room, bed=self.main_bed))
+            self.log_arrival(patient)
                 
             interarrival_time = self.patient_interarrival_dist()
             yield self.env.timeout(interarrival_time)
             patient_num += 1
+            
+    def log_arrival(self, patient:Patient):
+        """Log the arrival time and type of a patient"""
+        self.arrival_log.append({"Time": self.env.now, "Patient": patient.num, "Type": patient.type})
+
+
+def get_stations_list(station_config_list):
+    """ Converts station configurations, as stored in the app's session state, to Station objects. """
+    return [
+        Station(
+            name=station_config['name'],
+            num_staff=station_config['num_staff'],
+            treatment_time_dist=get_distribution_function(station_config['distribution'], station_config['parameters']),
+            prob_station_needed=station_config['prob_station_needed']
+        )
+        for station_config in station_config_list
+    ]
+
+def get_ed_settings(stations, patient):
+    """ Builds the EmergencyDepartment inputs from station configurations by station type and a patient configuration. """
+    return {
+        "main_labs": get_stations_list(stations["Main Lab"]),
+        "main_dr_room": get_stations_list(stations["Main Doctor's Room"])[0],
+        "main_bed": get_stations_list(stations["Main Beds"])[0],
+        "ft_labs": get_stations_list(stations["Fast Track Lab"]),
+        "ft_dr_room": get_stations_list(stations["Fast Track Doctor's Room"])[0],
+        "prob_patient_fast_track": patient["prob_patient_fast_track"],
+        "patient_interarrival_dist": get_distribution_function(patient["distribution"], patient["parameters"]),
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+from distributed import DEFAULT_SPEC, Coordinator, run_replication, start_local_workers
+
+SPEC = {**DEFAULT_SPEC, "burn_in_period": 100}
+
+
+@pytest.fixture(scope="module")
+def worker_addresses():
+    processes, addresses = start_local_workers(2)
+    yield addresses
+    for process in processes:
+        process.kill()
+
+
+def test_repeated_runs_on_one_coordinator(worker_addresses):
+    C = Coordinator(worker_addresses, chunk_size=2)
+    num_threads = threading.active_count()
+
+    for seeds in [range(4), range(2, 7)]:
+        assert C.run_replications(SPEC, seeds) == [run_replication(SPEC, seed) for seed in seeds]
+        assert threading.active_count() == num_threads
+
+
+def test_failed_run_does_not_leak_into_next_run(worker_addresses):
+    C = Coordinator(worker_addresses, chunk_size=1)
+    num_threads = threading.active_count()
+
+    with pytest.raises(RuntimeError):
+        C.run_replications({**SPEC, "stations": {}}, range(4))
+    assert threading.active_count() == num_threads
+
+    assert C.run_replications(SPEC, range(4)) == [run_replication(SPEC, seed) for seed in range(4)]
+    assert threading.active_count() == num_threads